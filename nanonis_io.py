@@ -1,8 +1,91 @@
-import re
+import mmap
+import os
+import sys
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import zip_longest
+
+# payloads at least this large are byte-swapped with one thread per frame
+_PARALLEL_CONVERT_BYTES = 16 * 2**20
+
+def _line_subtract(frame):
+    # remove each scan line's mean (row offsets from the feedback loop)
+    return frame - frame.mean(axis=1, keepdims=True)
+
+def _plane_subtract(frame):
+    # Least-squares plane z = a*x + b*y + c over the whole frame. On a regular grid with
+    # centered coordinates the normal equations decouple, so each term is a single reduction.
+    y_pixels, x_pixels = frame.shape
+    xc = np.arange(x_pixels) - (x_pixels - 1) / 2
+    yc = np.arange(y_pixels) - (y_pixels - 1) / 2
+    xx = (xc * xc).sum()
+    yy = (yc * yc).sum()
+    a = frame.sum(axis=0) @ xc / (y_pixels * xx) if xx else 0.0
+    b = frame.sum(axis=1) @ yc / (x_pixels * yy) if yy else 0.0
+    return frame - frame.mean() - a * xc[np.newaxis, :] - b * yc[:, np.newaxis]
+
+def _fb_average(fwd, bwd):
+    # Backward frames are stored mirrored along x; flip them back, shift the backward frame
+    # onto the forward frame's mean (re-registration) and average the two
+    bwd = bwd[:, ::-1]
+    return (fwd + bwd - bwd.mean() + fwd.mean()) / 2
+
+class _FramePair:
+    """
+    Forward and backward frames of one channel. Slots keep it lighter than a dict, while
+    the mapping methods keep data['Z']['forward'] style access (read and write) working.
+    """
+    __slots__ = ("forward", "backward")
+
+    def __init__(self, forward, backward):
+        self.forward = forward
+        self.backward = backward
+
+    def __getitem__(self, direction):
+        if direction not in self.__slots__:
+            raise KeyError(direction)
+        return getattr(self, direction)
+
+    def __setitem__(self, direction, array):
+        if direction not in self.__slots__:
+            raise KeyError(direction)
+        setattr(self, direction, array)
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __contains__(self, direction):
+        return direction in self.__slots__
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def get(self, direction, default=None):
+        return getattr(self, direction) if direction in self.__slots__ else default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, direction) for direction in self.__slots__]
+
+    def items(self):
+        return [(direction, getattr(self, direction)) for direction in self.__slots__]
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def __eq__(self, other):
+        # same semantics as comparing the per-channel dicts this replaces
+        if isinstance(other, (_FramePair, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
 
 class SpmImage:
+    # '>' becomes '_' and ':' is dropped in one pass over header keys
+    _PRETTIFY_TABLE = str.maketrans({'>': '_', ':': None})
+
     def __init__(self, filename):
         self.filename = filename
         self.header = {}
@@ -13,6 +96,7 @@ class SpmImage:
         self.scanpixels = None
         self.scan_direction = None
         self.bias = None
+        self.z_controller = {}
         self.z_feedback = None
         self.z_feedback_setpoint = None
         self.z_feedback_setpoint_unit = None
@@ -23,32 +107,40 @@ class SpmImage:
         self.channel_units = []
         self.channel_indices_fwd = []
         self.channel_indices_bwd = []
+        self.data_offset = None
+        self.frames = None
+        self.frame_index = {}
+        self._previews = {}
         self.data = None
 
     def _string_prettify(self, s):
-        return s.replace('>', '_').replace(':', '').strip()
+        return s.translate(self._PRETTIFY_TABLE).strip()
+
+    def _parse_header(self, buf):
+        # Locate the end marker with a single C-level byte search over the mapped file
+        end = buf.find(b"\n:SCANIT_END:") + 1
+        if end == 0:
+            raise ValueError(f":SCANIT_END: not found in {self.filename}")
+        line_end = buf.find(b"\n", end)
+        line_end = len(buf) if line_end == -1 else line_end + 1
+        self.data_offset = line_end + 4 # payload follows the marker line and the 4-byte signature
 
-    def _parse_header(self, f):
-        caption = re.compile(r"^:.*:")
         key = ""
-        contents = ""
+        content_parts = [] # joined once per key instead of growing a string
 
-        for line in f:
+        for line in buf[:end].decode('latin1').split("\n"):
             line = line.strip()
-            if line == ":SCANIT_END:":
+            # captions look like ':KEY:' with a non-empty key; plain string checks beat a regex here
+            if len(line) > 2 and line.startswith(':') and line.endswith(':'):
                 if key:
-                    self.header[key] = contents.strip()
-                break
-
-            if caption.match(line):
-                if key:
-                    self.header[key] = contents.strip()
+                    self.header[key] = "\n".join(content_parts).strip()
                 key = self._string_prettify(line[1:-1])  # skip leading/trailing ':'
-                contents = ""
+                content_parts = []
             else:
-                if contents:
-                    contents += "\n"
-                contents += line
+                content_parts.append(line)
+
+        if key:
+            self.header[key] = "\n".join(content_parts).strip()
 
     def print_header_keys_table(self, num_columns=4):
         """
@@ -62,40 +154,41 @@ class SpmImage:
         # Determine the maximum width needed for any key
         max_key_len = max(len(key) for key in items) + 2 # +2 for a little padding
 
-        print("\n--- Available Header Keys ---")
+        lines = ["\n--- Available Header Keys ---"]
 
         # Calculate the number of rows needed
         num_rows = (len(items) + num_columns - 1) // num_columns
 
-        for r in range(num_rows):
-            row_items = []
-            for c in range(num_columns):
-                idx = r + c * num_rows # Calculate index for column-major order
-                if idx < len(items):
-                    row_items.append(items[idx])
-                else:
-                    row_items.append("") # Fill with empty string for alignment
-
-            # Format and print the row
-            print(" | ".join(f"{item:<{max_key_len}}" for item in row_items))
+        # Pad every key once, chunk the keys into columns and transpose them into
+        # rows (column-major order); short columns are filled with blanks for alignment
+        padded = [f"{item:<{max_key_len}}" for item in items]
+        columns = [padded[i:i + num_rows] for i in range(0, len(padded), num_rows)]
+        columns += [[]] * (num_columns - len(columns))
+        lines.extend(" | ".join(row) for row in zip_longest(*columns, fillvalue=" " * max_key_len))
 
-        print("-----------------------------\n")
+        lines.append("-----------------------------\n")
+        sys.stdout.write("\n".join(lines) + "\n") # one write for the whole table
 
-    def _parse_metadata(self):
-        self.print_header_keys_table(num_columns=4)
+    def _parse_metadata(self, verbose=True):
+        if verbose:
+            self.print_header_keys_table(num_columns=4)
         
         self.scanfile = self.header['SCAN_FILE']
-        self.scanpixels = [int(x) for x in self.header['SCAN_PIXELS'].split()]
-        self.scansize = [float(x) for x in self.header['SCAN_RANGE'].split()] # in m
-        self.center = [float(x) for x in self.header['SCAN_OFFSET'].split()] # in m
+        # tokenized and converted in C straight into numpy arrays for downstream arithmetic
+        self.scanpixels = np.fromstring(self.header['SCAN_PIXELS'], dtype=np.int64, sep=' ')
+        self.scansize = np.fromstring(self.header['SCAN_RANGE'], dtype=np.float64, sep=' ') # in m
+        self.center = np.fromstring(self.header['SCAN_OFFSET'], dtype=np.float64, sep=' ') # in m
         self.angle = float(self.header['SCAN_ANGLE'])
         
         self.scan_direction = "up" if self.header['SCAN_DIR'] == "up" else "down"
         self.bias = float(self.header['BIAS'])
 
-        z_data = self.header['Z-CONTROLLER'].split("\t")
-        self.z_feedback = z_data[8] == "1"
-        z_setpoint = z_data[9].split()
+        # Z-CONTROLLER is a tab-separated title row (Name, on, Setpoint, ...) and value row;
+        # tokenize it once into a dict that callers can reuse instead of re-splitting
+        z_titles, z_values = (line.split("\t") for line in self.header['Z-CONTROLLER'].split("\n")[:2])
+        self.z_controller = dict(zip(z_titles, z_values))
+        self.z_feedback = self.z_controller["on"] == "1"
+        z_setpoint = self.z_controller["Setpoint"].split()
         self.z_feedback_setpoint = float(z_setpoint[0])
         self.z_feedback_setpoint_unit = z_setpoint[1] if len(z_setpoint) > 1 else ""
 
@@ -103,11 +196,16 @@ class SpmImage:
         if z_key in self.header:
             self.z = float(self.header[z_key])
 
-        self.start_time = datetime.strptime(
-            self.header['REC_DATE'] + " " + self.header['REC_TIME'], "%d.%m.%Y %H:%M:%S"
-        )
+        # REC_DATE is DD.MM.YYYY and REC_TIME is HH:MM:SS; plain int parsing avoids strptime
+        day, month, year = (int(x) for x in self.header['REC_DATE'].split("."))
+        hour, minute, second = (int(x) for x in self.header['REC_TIME'].split(":"))
+        self.start_time = datetime(year, month, day, hour, minute, second)
         self.acquisition_time = float(self.header['ACQ_TIME'])
-        self.channel_names, self.channel_units = self._get_channel_names_units()
+        # DATA_INFO is tokenized once and shared by the printout and the channel parsing
+        data_info_rows = self._data_info_rows()
+        if verbose:
+            self.print_data_info_table(data_info_rows)
+        self.channel_names, self.channel_units = self._get_channel_names_units(data_info_rows)
         self.channel_indices_fwd = list(range(0, len(self.channel_names) * 2, 2))
         self.channel_indices_bwd = list(range(1, len(self.channel_names) * 2, 2))
         
@@ -115,83 +213,182 @@ class SpmImage:
         x_pixels, y_pixels = self.scanpixels
         num_channels_actual = len(self.channel_names) 
 
-        f.read(4) # Skip the 4-byte signature
-
         total_values = x_pixels * y_pixels * num_channels_actual * 2 # Total for all channels, all directions
-        raw = np.fromfile(f, dtype='>f4', count=total_values) # big-endians float32
+        nbytes = total_values * 4 # 4 bytes per float32
+
+        # On disk each channel stores its forward frame then its backward frame, so one
+        # contiguous (num_channels * 2, y, x) block keeps every frame C-contiguous.
+        # The big-endian payload is read straight into that block with one bulk readinto,
+        # so the mmap used for the header never exports its buffer and always closes cleanly.
+        frames = np.empty((num_channels_actual * 2, y_pixels, x_pixels), dtype=np.float32)
+        f.seek(self.data_offset)
+        if f.readinto(frames) != nbytes:
+            raise ValueError(f"{self.filename} is truncated: expected {nbytes} bytes of image data")
+
+        # byte-swap once, in place, into native float32 so later numpy ops don't pay for it
+        workers = min(os.cpu_count() or 1, len(frames))
+        if workers > 1 and nbytes >= _PARALLEL_CONVERT_BYTES:
+            # numpy releases the GIL while casting, so frames convert concurrently
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(lambda i: np.copyto(frames[i], frames[i].view('>f4')), range(len(frames))))
+        else:
+            np.copyto(frames, frames.view('>f4'))
 
-        reshaped_data = raw.reshape((num_channels_actual, 2, y_pixels, x_pixels)) # this reshaping logic will affect the nested structure 
+        self._set_frames(frames)
 
+    def _map_binary_data(self):
+        x_pixels, y_pixels = self.scanpixels
+        num_channels_actual = len(self.channel_names)
+
+        # Lazy big-endian view of the payload;
+        # the OS only reads the pages of the frames that are actually touched
+        frames = np.memmap(self.filename, dtype='>f4', mode='r', offset=self.data_offset,
+                           shape=(num_channels_actual * 2, y_pixels, x_pixels))
+        self._set_frames(frames)
+
+    def _set_frames(self, frames):
+        self.frames = frames
+        self._previews = {}
+        self.frame_index = {
+            channel_name: (fwd, bwd)
+            for channel_name, fwd, bwd in zip(self.channel_names, self.channel_indices_fwd, self.channel_indices_bwd)
+        }
+
+        # per-channel views into self.frames, for data['Z'].forward or data['Z']['forward'] access
         self.data = {}
-        for i, channel_name in enumerate(self.channel_names):
-            self.data[channel_name] = {
-                "forward": reshaped_data[i, 0, :, :],
-                "backward": reshaped_data[i, 1, :, :]
-            }
+        for channel_name, (fwd, bwd) in self.frame_index.items():
+            self.data[channel_name] = _FramePair(self.frames[fwd], self.frames[bwd])
 
-    def _get_channel_names_units(self):
+    def frame(self, channel_name, direction="forward"):
+        """
+        Returns the (y, x) frame of a channel for direction 'forward' or 'backward'.
+        This is the same array as data[channel_name][direction]: a view into self.frames,
+        or the native copy once the channel has been materialized.
+        """
+        if self.frames is None:
+            raise ValueError("No data loaded yet. Call load() first.")
+        if direction not in ("forward", "backward"):
+            raise ValueError(f"direction must be 'forward' or 'backward', got {direction!r}")
+        return self.data[channel_name][direction]
 
-        lines = self.header['DATA_INFO'].split("\n")
-    
+    def materialize(self, channel_name):
+        """
+        Copies both frames of a channel into native float32 arrays, e.g. after load(memmap=True).
+        Replaces and returns self.data[channel_name]; frame(), corrected() and preview() then
+        use the copies too, while self.frames keeps the original (possibly mapped) block.
+        """
+        if self.frames is None:
+            raise ValueError("No data loaded yet. Call load() first.")
+        fwd, bwd = self.frame_index[channel_name]
+        self.data[channel_name] = _FramePair(self.frames[fwd].astype(np.float32), self.frames[bwd].astype(np.float32))
+        # previews of this channel were built from the mapped frames
+        self._previews = {key: value for key, value in self._previews.items() if key[0] != channel_name}
+        return self.data[channel_name]
+
+    def preview(self, channel_name, direction="forward", dtype=np.float16):
+        """
+        Returns a channel frame rescaled for display in a narrow dtype: [0, 1] for float dtypes
+        (raw SI values would underflow float16) or the full range of an integer dtype.
+        Results are cached per channel, direction and dtype.
+        """
+        dtype = np.dtype(dtype)
+        cache_key = (channel_name, direction, dtype)
+        if cache_key not in self._previews:
+            frame = self.frame(channel_name, direction)
+            lo, hi = np.nanmin(frame), np.nanmax(frame)
+            scaled = (frame - lo) / (hi - lo) if hi > lo else np.zeros(frame.shape, dtype=np.float32)
+            if dtype.kind in "iu":
+                info = np.iinfo(dtype)
+                # rescale in float64 (float32 cannot hold the 32/64-bit range) and clip so the
+                # brightest pixel cannot wrap; NaN pixels (e.g. an aborted scan) map to the lowest value
+                top = float(info.max)
+                if int(top) > info.max: # 64-bit maxima round up in float64
+                    top = float(np.nextafter(top, 0.0))
+                scaled = np.nan_to_num(scaled.astype(np.float64)) * (top - float(info.min)) + float(info.min)
+                scaled = np.clip(np.rint(scaled), float(info.min), top)
+            self._previews[cache_key] = scaled.astype(dtype)
+        return self._previews[cache_key]
+
+    def corrected(self, channel_name, method="plane", direction="forward"):
+        """
+        Returns a background-corrected float32 copy of a channel frame.
+        method is 'plane' (least-squares plane subtraction), 'line' (per-line mean subtraction)
+        or 'average' (forward and mirrored backward frames averaged; direction is ignored).
+        """
+        corrections = {"plane": _plane_subtract, "line": _line_subtract}
+        if method == "average":
+            # average in float64 so the mean re-registration stays accurate on large frames
+            fwd = self.frame(channel_name, "forward").astype(np.float64)
+            bwd = self.frame(channel_name, "backward").astype(np.float64)
+            return _fb_average(fwd, bwd).astype(np.float32)
+        if method not in corrections:
+            raise ValueError(f"method must be 'plane', 'line' or 'average', got {method!r}")
+        # fit in float64 so the reductions stay accurate on large frames
+        frame = self.frame(channel_name, direction).astype(np.float64)
+        return corrections[method](frame).astype(np.float32)
+
+    def _data_info_rows(self):
+        # non-empty DATA_INFO rows split into fields; the first row holds the column titles
+        return [entries for entries in (line.split() for line in self.header['DATA_INFO'].split("\n")) if entries]
+
+    def _get_channel_names_units(self, data_info_rows):
         names = []
         units = []
 
-        table_data = []
-    
-        for (i, line) in enumerate(lines):
-            
-            entries = line.split()
-            table_data.append(entries)
-            
-            if len(entries) > 1 and i != 0:
-                
+        for entries in data_info_rows[1:]:
+            if len(entries) > 1:
                 names.append(entries[1].replace("_", " "))
                 units.append(entries[2])
                 if entries[3].lower() != "both":
                     raise NotImplementedError(
                         f"Only one direction recorded. This is not implemented yet. ({entries})"
                     )
-                
+
+        return names, units
+
+    def print_data_info_table(self, data_info_rows=None):
+        """
+        Prints the DATA_INFO channel table with aligned columns.
+        """
+        table_data = self._data_info_rows() if data_info_rows is None else data_info_rows
+
         # Get column widths (max length of each item in a column)
         # e.g. ('Channel', '30', '2', '3', '4', '24', '0', '95') and find max of the length of a string
-        column_widths = [max(len(str(item)) for item in col) for col in zip(*table_data)] 
-        
-        # Print the table header
+        column_widths = list(map(max, zip(*(map(len, row) for row in table_data))))
+
+        # Format the table header
         header_line = table_data[0]
         header_str = " | ".join(f"{item:<{width}}" for item, width in zip(header_line, column_widths))
-        print("\n" + "--- DATA_INFO ---")
-        print(header_str)
-        print("-" * len(header_str))
-        
-        # Print the data rows
+        lines = ["\n--- DATA_INFO ---", header_str, "-" * len(header_str)]
+
+        # Format the data rows
         for row in table_data[1:]:
-            row_str = " | ".join(f"{item:<{width}}" for item, width in zip(row, column_widths))
-            print(row_str)
-        print("-----------------\n")
+            lines.append(" | ".join(f"{item:<{width}}" for item, width in zip(row, column_widths)))
 
-        return names, units
+        lines.append("-----------------\n")
+        sys.stdout.write("\n".join(lines) + "\n") # one write for the whole table
 
-    def load(self, header_only=False, verbose=True):
+    def load(self, header_only=False, verbose=True, memmap=False):
+        # memmap=True maps the body read-only instead of reading it; frames stay
+        # big-endian on disk until touched or copied with materialize()
         if verbose:
             print(f"Reading header from {self.filename}")
 
-        with open(self.filename, 'r', encoding='latin1') as f:
-            self._parse_header(f)
+        # The header end is found by a byte search over a read-only mapping of the file;
+        # the payload is then read in bulk from the recorded offset
+        with open(self.filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            self._parse_header(mm)
 
-        self._parse_metadata()
+            self._parse_metadata(verbose)
 
-        if not header_only:
-            if verbose:
-                print(f"Reading body from {self.filename}")
-            
-            # Reopen in binary mode for reading the float32 image data
-            with open(self.filename, 'rb') as f:
-                # Seek to binary section (find :SCANIT_END:)
-                while True:
-                    line = f.readline()
-                    if line.strip() == b':SCANIT_END:':
-                        break
-                self._read_binary_data(f)
+            if not header_only:
+                if verbose:
+                    print(f"Reading body from {self.filename}")
+
+                if memmap:
+                    self._map_binary_data()
+                else:
+                    self._read_binary_data(f)
 
         return self
 
@@ -201,10 +398,10 @@ class SpmImage:
             return
 
         print("\n--- Data Shapes ---")
-        if isinstance(self.data, dict): # Check if it's the nested dict structure
+        if isinstance(self.data, dict): # Check if it's the per-channel structure
             for channel_name, directions in self.data.items():
                 print(f"   {channel_name}")
-                if isinstance(directions, dict):
+                if isinstance(directions, (_FramePair, dict)):
                     for direction, array in directions.items():
                         if isinstance(array, np.ndarray):
                             print(f"  {direction}: {array.shape}")